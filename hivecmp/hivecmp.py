@@ -5,25 +5,46 @@ Classes:
     hivecmp
 
 Functions:
-    cmp(f1, f2, shallow=1) -> int
-    cmpfiles(a, b, common) -> ([], [], [])
+    cmp(f1, f2, shallow=1, s1=None, s2=None) -> int
+    cmpfiles(a, b, common, shallow=1, digest=None, stats=None) -> ([], [], [])
 
 """
 
 import os
 import stat
-from itertools import ifilter, ifilterfalse, imap, izip
-import ConfigParser
+import mmap
+import ctypes
+import hashlib
+import threading
+from itertools import filterfalse
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import configparser
 import shutil
 from ast import literal_eval
 import sys
 
 __all__ = ["cmp","hivecmp","cmpfiles"]
 
-_cache = {}
-BUFSIZE=8*1024
-
-def cmp(f1, f2, shallow=1):
+BUFSIZE=1024*1024
+_buffers = threading.local()
+MAX_WORKERS=32
+_pool = None
+_pool_lock = threading.Lock()
+try:
+    _memcmp = ctypes.CDLL(None).memcmp
+    _memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+    _memcmp.restype = ctypes.c_int
+except (OSError, TypeError, AttributeError): # No process-wide libc (Windows)
+    _memcmp = None
+# ctypes can only address writable buffers. A copy-on-write mapping is
+# writable, and its pages stay shared with the page cache as long as
+# nothing writes to them.
+_MMAP_ACCESS = mmap.ACCESS_READ if _memcmp is None else mmap.ACCESS_COPY
+# normcase is the identity here, so names can be matched as they are
+_CASE_SENSITIVE = os.path.normcase('A') == 'A'
+
+def cmp(f1, f2, shallow=1, s1=None, s2=None):
     """Compare two files.
 
     Arguments:
@@ -35,47 +56,154 @@ def cmp(f1, f2, shallow=1):
     shallow -- Just check stat signature (do not read the files).
                defaults to 1.
 
+    s1, s2 -- os.stat() results for f1 and f2 when the caller already
+              has them (e.g. from os.scandir); they are stat'ed otherwise.
+
     Return value:
 
     True if the files are the same, False otherwise.
 
-    This function uses a cache for past comparisons and the results,
-    with a cache invalidation mechanism relying on stale signatures.
+    This function uses a bounded LRU cache for past comparisons, keyed
+    on the file names and their stat signatures so stale entries are
+    never hit. cmp.cache_clear() empties it.
 
     """
 
-    s1 = _sig(os.stat(f1))
-    s2 = _sig(os.stat(f2))
+    if s1 is None:
+        s1 = os.stat(f1)
+    if s2 is None:
+        s2 = os.stat(f2)
+    return _cmp_sigs(f1, f2, _sig(s1), _sig(s2), shallow)
+
+def _cmp_sigs(f1, f2, s1, s2, shallow):
     if s1[0] != stat.S_IFREG or s2[0] != stat.S_IFREG:
         return False
     if shallow and s1 == s2:
         return True
     if s1[1] != s2[1]:
         return False
+    return _cmp_cached(f1, f2, s1, s2)
 
-    result = _cache.get((f1, f2))
-    if result and (s1, s2) == result[:2]:
-        return result[2]
-    outcome = _do_cmp(f1, f2)
-    _cache[f1, f2] = s1, s2, outcome
-    return outcome
+@lru_cache(maxsize=4096)
+def _cmp_cached(f1, f2, s1, s2):
+    return _do_cmp(f1, f2)
+
+cmp.cache_clear = _cmp_cached.cache_clear
 
 def _sig(st):
     return (stat.S_IFMT(st.st_mode),
             st.st_size,
-            st.st_mtime)
+            st.st_mtime_ns)
 
 def _do_cmp(f1, f2):
-    bufsize = BUFSIZE
-    fp1 = open(f1, 'rb')
-    fp2 = open(f2, 'rb')
+    with open(f1, 'rb') as fp1, open(f2, 'rb') as fp2:
+        fd1 = fp1.fileno()
+        fd2 = fp2.fileno()
+        size = os.fstat(fd1).st_size
+        if size != os.fstat(fd2).st_size:
+            return False
+        if not size:
+            return True
+        # Start readahead before the compare asks for the pages
+        _fadvise(fd1, 'POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_WILLNEED')
+        _fadvise(fd2, 'POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_WILLNEED')
+        try:
+            return _do_cmp_mmap(fp1, fp2)
+        finally:
+            # A large tree walk shouldn't evict more useful cached pages
+            _fadvise(fd1, 'POSIX_FADV_DONTNEED')
+            _fadvise(fd2, 'POSIX_FADV_DONTNEED')
+
+def _do_cmp_mmap(fp1, fp2):
+    try:
+        m1 = mmap.mmap(fp1.fileno(), 0, access=_MMAP_ACCESS)
+    except (ValueError, OSError):
+        # Not mappable (pipes, some network filesystems), read it instead
+        return _do_cmp_read(fp1, fp2)
+    try:
+        try:
+            m2 = mmap.mmap(fp2.fileno(), 0, access=_MMAP_ACCESS)
+        except (ValueError, OSError):
+            return _do_cmp_read(fp1, fp2)
+        try:
+            # Map lengths are the sizes now, which may differ from the
+            # earlier fstat if a file changed in between
+            size = len(m1)
+            if size != len(m2):
+                return False
+            if _memcmp is not None:
+                return _mmap_memcmp(m1, m2, size)
+            # Compare in strides so huge files never get fully resident
+            stride = BUFSIZE
+            for off in range(0, size, stride):
+                if m1[off:off+stride] != m2[off:off+stride]:
+                    return False
+            return True
+        finally:
+            m2.close()
+    finally:
+        m1.close()
+
+def _mmap_memcmp(m1, m2, size):
+    # libc memcmp straight on the mappings: no slice copies, and ctypes
+    # releases the GIL for the call
+    c1 = ctypes.c_char.from_buffer(m1)
+    c2 = ctypes.c_char.from_buffer(m2)
+    try:
+        return _memcmp(ctypes.addressof(c1), ctypes.addressof(c2), size) == 0
+    finally:
+        # Drop the buffer exports, or the maps can't be closed
+        del c1, c2
+
+def _do_cmp_read(fp1, fp2):
+    buf1, buf2 = _get_buffers()
+    bufsize = len(buf1)
     while True:
-        b1 = fp1.read(bufsize)
-        b2 = fp2.read(bufsize)
-        if b1 != b2:
+        n1 = fp1.readinto(buf1)
+        n2 = fp2.readinto(buf2)
+        if n1 != n2:
             return False
-        if not b1:
+        if not n1:
             return True
+        # bytearray equality is a single memcmp; memoryview equality
+        # unpacks item by item, so only slice on a short (final) read
+        if n1 == bufsize:
+            if buf1 != buf2:
+                return False
+        elif buf1[:n1] != buf2[:n2]:
+            return False
+
+def _get_buffers():
+    # One pair of read buffers per thread, reused across comparisons
+    bufs = getattr(_buffers, 'bufs', None)
+    if bufs is None or len(bufs[0]) != BUFSIZE:
+        bufs = _buffers.bufs = (bytearray(BUFSIZE), bytearray(BUFSIZE))
+    return bufs
+
+def _fadvise(fd, *advice):
+    # posix_fadvise is a hint only, and missing on Windows
+    for name in advice:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, name))
+        except (AttributeError, OSError):
+            pass
+
+# Attribute computed on first access by running a hivecmp phase, which
+# stores it (and its siblings) in the instance __dict__. That shadows
+# this non-data descriptor, so later reads are plain attribute loads.
+#
+class _lazy:
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        self.phase(obj)
+        return obj.__dict__[self.name]
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
 # Directory comparison class.
 #
@@ -116,6 +244,9 @@ class hivecmp:
     def __init__(self, a, b, ignore=None, hide=None): # Initialize
         self.left = a
         self.right = b
+        # Joined once, so per-name paths are a plain concatenation
+        self._left_prefix = os.path.join(a, '')
+        self._right_prefix = os.path.join(b, '')
         if hide is None:
             self.hide = [os.curdir, os.pardir] # Names never to be shown
         else:
@@ -126,57 +257,71 @@ class hivecmp:
             self.ignore = ignore
 
     def phase0(self): # Compare everything except common subdirectories
-        self.left_list = _filter(os.listdir(self.left),
-                                 self.hide+self.ignore)
-        self.right_list = _filter(os.listdir(self.right),
-                                  self.hide+self.ignore)
-        self.left_list.sort()
-        self.right_list.sort()
+        skip = frozenset(self.hide).union(self.ignore)
+        self._left_entries = _scan(self.left, skip)
+        self._right_entries = _scan(self.right, skip)
+        self.left_list = sorted(self._left_entries)
+        self.right_list = sorted(self._right_entries)
 
     def phase1(self): # Compute common names
-        a = dict(izip(imap(os.path.normcase, self.left_list), self.left_list))
-        b = dict(izip(imap(os.path.normcase, self.right_list), self.right_list))
-        self.common = map(a.__getitem__, ifilter(b.__contains__, a))
-        self.left_only = map(a.__getitem__, ifilterfalse(b.__contains__, a))
-        self.right_only = map(b.__getitem__, ifilterfalse(a.__contains__, b))
+        if _CASE_SENSITIVE:
+            # Both lists are sorted by phase0: split them in one merge pass
+            left, right = self.left_list, self.right_list
+            common, left_only, right_only = [], [], []
+            i = j = 0
+            nl, nr = len(left), len(right)
+            while i < nl and j < nr:
+                x = left[i]
+                y = right[j]
+                if x == y:
+                    common.append(x)
+                    i += 1
+                    j += 1
+                elif x < y:
+                    left_only.append(x)
+                    i += 1
+                else:
+                    right_only.append(y)
+                    j += 1
+            left_only.extend(left[i:])
+            right_only.extend(right[j:])
+            self.common = common
+            self.left_only = left_only
+            self.right_only = right_only
+            return
+        normcase = os.path.normcase
+        a = {normcase(n): n for n in self.left_list}
+        b = {normcase(n): n for n in self.right_list}
+        self.common = list(map(a.__getitem__, filter(b.__contains__, a)))
+        self.left_only = list(map(a.__getitem__, filterfalse(b.__contains__, a)))
+        self.right_only = list(map(b.__getitem__, filterfalse(a.__contains__, b)))
+
+    # phase2 buckets by (left type, right type): 0 common_dirs,
+    # 1 common_files, anything else 2 common_funny
+    _BUCKET = {(stat.S_IFDIR, stat.S_IFDIR): 0,
+               (stat.S_IFREG, stat.S_IFREG): 1}
 
     def phase2(self): # Distinguish files, directories, funnies
         self.common_dirs = []
         self.common_files = []
         self.common_funny = []
 
+        buckets = (self.common_dirs, self.common_files, self.common_funny)
+        bucket = self._BUCKET.get
+        left, right = self._left_entries, self._right_entries
+        lp, rp = self._left_prefix, self._right_prefix
         for x in self.common:
-            a_path = os.path.join(self.left, x)
-            b_path = os.path.join(self.right, x)
-
-            ok = 1
-            try:
-                a_stat = os.stat(a_path)
-            except os.error, why:
-                # print 'Can\'t stat', a_path, ':', why[1]
-                ok = 0
             try:
-                b_stat = os.stat(b_path)
-            except os.error, why:
-                # print 'Can\'t stat', b_path, ':', why[1]
-                ok = 0
-
-            if ok:
-                a_type = stat.S_IFMT(a_stat.st_mode)
-                b_type = stat.S_IFMT(b_stat.st_mode)
-                if a_type != b_type:
-                    self.common_funny.append(x)
-                elif stat.S_ISDIR(a_type):
-                    self.common_dirs.append(x)
-                elif stat.S_ISREG(a_type):
-                    self.common_files.append(x)
-                else:
-                    self.common_funny.append(x)
-            else:
-                self.common_funny.append(x)
+                types = (_ftype(left.get(x), lp, x),
+                         _ftype(right.get(x), rp, x))
+            except OSError:
+                # Can't stat one side
+                types = None
+            buckets[bucket(types, 2)].append(x)
 
     def phase3(self): # Find out differences between common files
-        xx = cmpfiles(self.left, self.right, self.common_files)
+        xx = cmpfiles(self.left, self.right, self.common_files,
+                      stats=self._common_file_stats())
         self.same_files, self.diff_files, self.funny_files = xx
 
     def phase4(self): # Find out differences between common subdirectories
@@ -185,55 +330,71 @@ class hivecmp:
         # The hide and ignore properties are inherited from the parent
         self.subdirs = {}
         for x in self.common_dirs:
-            a_x = os.path.join(self.left, x)
-            b_x = os.path.join(self.right, x)
+            a_x = self._left_prefix + x
+            b_x = self._right_prefix + x
             self.subdirs[x]  = hivecmp(a_x, b_x, self.ignore, self.hide)
 
-    def phase4_closure(self): # Recursively call phase4() on subdirectories
-        self.phase4()
-        for sd in self.subdirs.itervalues():
-            sd.phase4_closure()
+    def _common_file_stats(self): # Stats of common files via their scandir entries
+        left, right = self._left_entries, self._right_entries
+        return [(_entry_stat(left.get(x)), _entry_stat(right.get(x)))
+                for x in self.common_files]
+
+    def phase4_closure(self): # Call phase4() on all subdirectories
+        stack = [self]
+        while stack:
+            d = stack.pop()
+            d.phase4()
+            stack.extend(d.subdirs.values())
+
+    def _closure(self): # Self and all subdirectories, in report order
+        nodes = []
+        stack = [self]
+        while stack:
+            d = stack.pop()
+            nodes.append(d)
+            stack.extend(reversed(list(d.subdirs.values())))
+        return nodes
 
     def report(self): # Print a report on the differences between a and b
         # Output format is purposely lousy
-        print 'diff', self.left, self.right
+        print('diff', self.left, self.right)
         if self.left_only:
             self.left_only.sort()
-            print 'Only in', self.left, ':', self.left_only
+            print('Only in', self.left, ':', self.left_only)
         if self.right_only:
             self.right_only.sort()
-            print 'Only in', self.right, ':', self.right_only
+            print('Only in', self.right, ':', self.right_only)
         if self.same_files:
             self.same_files.sort()
-            print 'Identical files :', self.same_files
+            print('Identical files :', self.same_files)
         if self.diff_files:
             self.diff_files.sort()
-            print 'Differing files :', self.diff_files
+            print('Differing files :', self.diff_files)
         if self.funny_files:
             self.funny_files.sort()
-            print 'Trouble with common files :', self.funny_files
+            print('Trouble with common files :', self.funny_files)
         if self.common_dirs:
             self.common_dirs.sort()
-            print 'Common subdirectories :', self.common_dirs
+            print('Common subdirectories :', self.common_dirs)
         if self.common_funny:
             self.common_funny.sort()
-            print 'Common funny cases :', self.common_funny
+            print('Common funny cases :', self.common_funny)
 
     def report_partial_closure(self): # Print reports on self and on subdirs
         self.report()
-        for sd in self.subdirs.itervalues():
-            print
+        for sd in self.subdirs.values():
+            print()
             sd.report()
 
     def report_full_closure(self): # Report on self and subdirs recursively
-        self.report()
-        for sd in self.subdirs.itervalues():
-            print
-            sd.report_full_closure()
+        for i, d in enumerate(self._closure()):
+            if i:
+                print()
+            d.report()
 
     ######################################
     ### Custom functions below
-    ### report_patch, report_full_closure_patch, dump_hive_diff
+    ### report_patch, patch_config, report_full_closure_patch, dump_hive_diff
     ### A hivepatch.ini will be created. Example below
     ######################################
     # [Root]
@@ -250,20 +411,22 @@ class hivecmp:
     ######################################
 
     def report_patch(self,output_file_name):
-        output_file_name = output_file_name
-        Config = ConfigParser.ConfigParser()
+        Config = configparser.ConfigParser(interpolation=None)
+        if os.path.isfile(output_file_name):
+            Config.read(output_file_name)
+        self.patch_config(Config)
+        with open(output_file_name,'w') as patch_file:
+            Config.write(patch_file)
 
+    def patch_config(self, Config): # Add this directory's changes to Config
         # self.left = os.path.splitdrive(self.left)[1].replace('/','\\')
         # self.right = os.path.splitdrive(self.right)[1].replace('/','\\')
 
         sanitized_left = os.path.splitdrive(self.left)[1].replace('/','\\')
         sanitized_right = os.path.splitdrive(self.right)[1].replace('/','\\')
         drive = os.path.splitdrive(self.right)[0]
-        # print sanitized_left
-        # print sanitized_right
-
-        if os.path.isfile(output_file_name):
-            Config.read(output_file_name)
+        # print(sanitized_left)
+        # print(sanitized_right)
 
         #[Root] section to show names of old and new folders
         if not Config.has_section("Root"):
@@ -275,34 +438,34 @@ class hivecmp:
         #[Only] section shows inserted/deleted files
         if self.left_only:
             self.left_only.sort()
-            # print 'Only in',sanitized_left, ':', self.left_only
+            # print('Only in',sanitized_left, ':', self.left_only)
             if not Config.has_section("Old"):
                 Config.add_section("Old")
-            Config.set('Old',sanitized_left,self.left_only)
+            Config.set('Old',sanitized_left,str(self.left_only))
         if self.right_only:
             self.right_only.sort()
-            # print 'Only in', sanitized_right, ':', self.right_only
+            # print('Only in', sanitized_right, ':', self.right_only)
             if not Config.has_section("New"):
                 Config.add_section("New")
-            Config.set('New',sanitized_right,self.right_only)
-
-        patch_file = open(output_file_name,'w')
-        Config.write(patch_file)
-        patch_file.close()
+            Config.set('New',sanitized_right,str(self.right_only))
 
 
     def report_full_closure_patch(self, output_file_name): # Report on self and subdirs recursively
-        self.report_patch(output_file_name)
-        for sd in self.subdirs.itervalues():
-            # print sd
-            sd.report_full_closure_patch(output_file_name)
+        # Build the whole patch in memory: the file is read and written once
+        Config = configparser.ConfigParser(interpolation=None)
+        if os.path.isfile(output_file_name):
+            Config.read(output_file_name)
+        for d in self._closure():
+            d.patch_config(Config)
+        with open(output_file_name,'w') as patch_file:
+            Config.write(patch_file)
 
 
     def dump_hive_diff(self): # Report on self and subdirs recursively
         output_file_name = "hivepatch.ini"
 
         if os.path.isfile(output_file_name):
-            Config = ConfigParser.ConfigParser()
+            Config = configparser.ConfigParser(interpolation=None)
             Config.read(output_file_name)
             old = Config.get('Root','old')
             new = Config.get('Root','new')
@@ -326,28 +489,38 @@ class hivecmp:
 
     ######################################
     ### Custom functions end
-    ### report_patch, report_full_closure_patch, dump_hive_diff
+    ### report_patch, patch_config, report_full_closure_patch, dump_hive_diff
     ######################################
 
 
-    methodmap = dict(subdirs=phase4,
-                     same_files=phase3, diff_files=phase3, funny_files=phase3,
-                     common_dirs = phase2, common_files=phase2, common_funny=phase2,
-                     common=phase1, left_only=phase1, right_only=phase1,
-                     left_list=phase0, right_list=phase0)
-
-    def __getattr__(self, attr):
-        if attr not in self.methodmap:
-            raise AttributeError, attr
-        self.methodmap[attr](self)
-        return getattr(self, attr)
-
-def cmpfiles(a, b, common, shallow=1):
+    # One _lazy per attribute: each needs its own __set_name__ name
+    subdirs = _lazy(phase4)
+    same_files = _lazy(phase3)
+    diff_files = _lazy(phase3)
+    funny_files = _lazy(phase3)
+    common_dirs = _lazy(phase2)
+    common_files = _lazy(phase2)
+    common_funny = _lazy(phase2)
+    common = _lazy(phase1)
+    left_only = _lazy(phase1)
+    right_only = _lazy(phase1)
+    left_list = _lazy(phase0)
+    right_list = _lazy(phase0)
+    _left_entries = _lazy(phase0)
+    _right_entries = _lazy(phase0)
+
+def cmpfiles(a, b, common, shallow=1, digest=None, stats=None):
     """Compare common files in two directories.
 
     a, b -- directory names
     common -- list of file names found in both directories
     shallow -- if true, do comparison based solely on stat() information
+    digest -- optional hashlib algorithm name (e.g. 'blake2b'). When given,
+              same-sized files are compared by content digest instead of
+              byte by byte. Digests are cached per file and signature, so
+              a file compared against several trees is read only once.
+    stats -- optional list, parallel to common, of (stat of a/x, stat of b/x)
+             pairs already known to the caller; a None in a pair is stat'ed
 
     Returns a tuple of three lists:
       files that compare equal
@@ -355,31 +528,136 @@ def cmpfiles(a, b, common, shallow=1):
       filenames that aren't regular files.
 
     """
+    ap = os.path.join(a, '')
+    bp = os.path.join(b, '')
+    if stats is None:
+        stats = [(None, None)] * len(common)
+    codes = []
+    pending = [] # (index in codes, a path, b path, sig a, sig b, digest)
+    for x, (sa, sb) in zip(common, stats):
+        ax = ap + x
+        bx = bp + x
+        try:
+            sa = _sig(os.stat(ax) if sa is None else sa)
+            sb = _sig(os.stat(bx) if sb is None else sb)
+        except OSError:
+            codes.append(2)
+            continue
+        code = _cmp_by_sigs(sa, sb, shallow)
+        if code is None:
+            pending.append((len(codes), ax, bx, sa, sb, digest))
+        codes.append(code)
+    if len(pending) < 2 or sum(job[3][1] for job in pending) < BUFSIZE:
+        # A pool handoff costs more than comparing a few small files
+        done = map(_cmp_contents, pending)
+    else:
+        # Content compares block in read syscalls with the GIL released,
+        # so the pool keeps several of them in flight at once
+        done = _get_pool().map(_cmp_contents, pending)
+    for job, code in zip(pending, done):
+        codes[job[0]] = code
     res = ([], [], [])
-    for x in common:
-        ax = os.path.join(a, x)
-        bx = os.path.join(b, x)
-        res[_cmp(ax, bx, shallow)].append(x)
+    for x, code in zip(common, codes):
+        res[code].append(x)
     return res
 
 
-# Compare two files.
+# Settle a pair of files from their stat signatures alone.
 # Return:
 #       0 for equal
 #       1 for different
-#       2 for funny cases (can't stat, etc.)
+#       2 for funny cases (not regular files)
+#       None when the contents have to be compared
+#
+def _cmp_by_sigs(sa, sb, sh):
+    if sa[0] != stat.S_IFREG or sb[0] != stat.S_IFREG:
+        return 2
+    if sa[1] != sb[1]:
+        return 1
+    if sh and sa == sb:
+        return 0
+    return None
+
+
+# Compare the contents of one pending cmpfiles pair, byte by byte or,
+# with a digest algorithm, by hash. Return 0, 1 or 2 (can't open, etc.)
 #
-def _cmp(a, b, sh, abs=abs, cmp=cmp):
+def _cmp_contents(job):
+    _, a, b, sa, sb, digest = job
     try:
-        return not abs(cmp(a, b, sh))
-    except os.error:
+        if digest:
+            return _digest(a, sa, digest) != _digest(b, sb, digest)
+        return not _cmp_cached(a, b, sa, sb)
+    except OSError:
         return 2
 
 
-# Return a copy with items that occur in skip removed.
+# Thread pool shared by all cmpfiles calls, started on first use.
 #
-def _filter(flist, skip):
-    return list(ifilterfalse(skip.__contains__, flist))
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(MAX_WORKERS)
+        return _pool
+
+def _reset_pool(): # A forked child has none of the parent's threads
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool)
+
+
+# Return the digest of file path, whose stat signature is sig, under
+# hashlib algorithm name. The signature keeps cached digests fresh.
+#
+@lru_cache(maxsize=4096)
+def _digest(path, sig, name):
+    with open(path, 'rb') as fp:
+        if hasattr(hashlib, 'file_digest'): # Python 3.11+
+            return hashlib.file_digest(fp, name).digest()
+        h = hashlib.new(name)
+        for chunk in iter(lambda: fp.read(BUFSIZE), b''):
+            h.update(chunk)
+        return h.digest()
+
+
+# Map the names in directory path, except those in skip, to their
+# os.scandir entries.
+#
+def _scan(path, skip):
+    with os.scandir(path) as it:
+        return {e.name: e for e in it if e.name not in skip}
+
+
+# Return the stat file type of name under directory prefix, following
+# symlinks. A scandir entry answers dirs and files from d_type without
+# a stat call; other types, and names missing from the scan (e.g. a
+# case-folded match), are stat'ed.
+#
+def _ftype(entry, prefix, name):
+    if entry is None:
+        return stat.S_IFMT(os.stat(prefix + name).st_mode)
+    if entry.is_dir():
+        return stat.S_IFDIR
+    if entry.is_file():
+        return stat.S_IFREG
+    return stat.S_IFMT(entry.stat().st_mode)
+
+
+# Return the stat of a scandir entry, taken on first use and cached on
+# the entry, or None without an entry or when the stat fails; cmpfiles
+# then stats the path itself and reports a failure as funny.
+#
+def _entry_stat(entry):
+    if entry is None:
+        return None
+    try:
+        return entry.stat()
+    except OSError:
+        return None
 
 
 # Demonstration and testing.
@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import hivecmp
+
+
+class Phase3StatFailureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.left = os.path.join(self.root, 'left')
+        self.right = os.path.join(self.root, 'right')
+        for d in (self.left, self.right):
+            os.mkdir(d)
+            with open(os.path.join(d, 'x'), 'w') as f:
+                f.write('x')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_file_removed_after_scan_is_funny(self):
+        d = hivecmp.hivecmp(self.left, self.right)
+        self.assertEqual(d.common_files, ['x'])
+        os.remove(os.path.join(self.left, 'x'))
+        self.assertEqual(d.same_files, [])
+        self.assertEqual(d.diff_files, [])
+        self.assertEqual(d.funny_files, ['x'])
+
+
+if __name__ == '__main__':
+    unittest.main()